@@ -96,7 +96,7 @@ def main_worker(gpu, args):
     lr = process_image(Image.open(args.lr), args.gpu)
     hr = process_image(Image.open(args.hr), args.gpu)
 
-    model_paths = glob(os.path.join(f"{args.model_dir}", "Generator_epoch*.pth"))
+    model_paths = glob(os.path.join(f"{args.model_dir}", "Generator_*.pth"))
     best_model = model_paths[0]
 
     for model_path in model_paths:
@@ -22,7 +22,8 @@ from torchvision.transforms import InterpolationMode as mode
 __all__ = [
     "check_image_file",
     "BaseTrainDataset", "BaseTestDataset",
-    "CustomTrainDataset", "CustomTestDataset"
+    "CustomTrainDataset", "CustomTestDataset",
+    "CUDAPrefetcher"
 ]
 
 
@@ -212,3 +213,57 @@ class CustomTestDataset(torch.utils.data.dataset.Dataset):
 
     def __len__(self):
         return len(self.sampler_filenames)
+
+
+class CUDAPrefetcher(object):
+    r"""Copy the next batch of a data loader to the GPU on a side stream while the current batch is computed."""
+
+    def __init__(self, dataloader: torch.utils.data.DataLoader, gpu: int = None,
+                 memory_format: torch.memory_format = torch.contiguous_format) -> None:
+        """
+        Args:
+            dataloader (torch.utils.data.DataLoader): Data loader to prefetch from.
+            gpu (optional, int): GPU id the batches are copied to. (Default: ``None``).
+            memory_format (optional, torch.memory_format): Memory format of the copied batches. (Default: ``torch.contiguous_format``).
+        """
+        self.dataloader = dataloader
+        self.gpu = gpu
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(gpu)
+        self.data_iter = None
+        self.batch = None
+
+    def reset(self):
+        r"""Start a new pass over the data loader and issue the copy of its first batch."""
+        self.data_iter = iter(self.dataloader)
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.data_iter)
+        except StopIteration:
+            self.batch = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.batch = [data.cuda(self.gpu, non_blocking=True).contiguous(memory_format=self.memory_format)
+                          for data in batch]
+
+    def next(self):
+        r"""Get the batch copied in the previous step.
+
+        Returns:
+            List of tensors on the GPU, ``None`` when the data loader is exhausted.
+        """
+        torch.cuda.current_stream(self.gpu).wait_stream(self.stream)
+        batch = self.batch
+        if batch is not None:
+            # The tensors were allocated on the side stream, keep them alive for the compute stream.
+            for data in batch:
+                data.record_stream(torch.cuda.current_stream(self.gpu))
+        self.preload()
+
+        return batch
+
+    def __len__(self):
+        return len(self.dataloader)
@@ -117,7 +117,18 @@ class VGGLoss(torch.nn.Module):
         for name, param in self.features.named_parameters():
             param.requires_grad = False
 
-    def forward(self, source: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
-        vgg_loss = torch.nn.functional.l1_loss(self.features(source), self.features(target))
+    def forward(self, source: torch.Tensor, target: torch.Tensor = None,
+                target_features: torch.Tensor = None) -> torch.Tensor:
+        """
+        Args:
+            source (torch.Tensor): Generated image.
+            target (optional, torch.Tensor): Reference image. Ignored when `target_features` is given.
+            target_features (optional, torch.Tensor): Pre-extracted VGG features of the reference image.
+        """
+        if target_features is None:
+            # The reference image never needs gradients.
+            with torch.no_grad():
+                target_features = self.features(target)
+        vgg_loss = torch.nn.functional.l1_loss(self.features(source), target_features)
 
         return vgg_loss
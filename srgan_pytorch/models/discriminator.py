@@ -16,7 +16,11 @@ import torch.nn as nn
 
 
 class DiscriminatorForVGG(nn.Module):
-    r"""The main architecture of the discriminator. Similar to VGG structure."""
+    r"""The main architecture of the discriminator. Similar to VGG structure.
+
+    The classifier has no terminal sigmoid, the output is the logit of the sample being real.
+    Train it with `nn.BCEWithLogitsLoss` and apply `torch.sigmoid` to read it as a probability.
+    """
 
     def __init__(self, image_size: int = 96) -> None:
         super(DiscriminatorForVGG, self).__init__()
@@ -59,8 +63,7 @@ class DiscriminatorForVGG(nn.Module):
         self.classifier = nn.Sequential(
             nn.Linear(512 * feature_size * feature_size, 1024),
             nn.LeakyReLU(negative_slope=0.2, inplace=True),
-            nn.Linear(1024, 1),
-            nn.Sigmoid()
+            nn.Linear(1024, 1)
         )
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
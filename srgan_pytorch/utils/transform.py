@@ -15,11 +15,13 @@ import PIL.BmpImagePlugin
 import cv2
 import numpy as np
 import torch
+import torchvision.io
 import torchvision.transforms as transforms
+import torchvision.utils
 from PIL import Image
 
 __all__ = [
-    "opencv2pil", "opencv2tensor", "pil2opencv", "process_image"
+    "opencv2pil", "opencv2tensor", "pil2opencv", "process_image", "save_jpeg"
 ]
 
 
@@ -74,3 +76,18 @@ def process_image(image: PIL.BmpImagePlugin.BmpImageFile, gpu: int = None) -> to
     if gpu is not None:
         input_tensor = input_tensor.cuda(gpu, non_blocking=True)
     return input_tensor
+
+
+def save_jpeg(tensor: torch.Tensor, filename: str, quality: int = 95) -> None:
+    """ Save a batch of images as a JPEG grid.
+
+    The grid is quantized to uint8 on the tensor's device, so only a quarter of the data is copied to the host.
+
+    Args:
+        tensor (torch.Tensor): Batch of images in range [0, 1].
+        filename (str): Path of the JPEG file.
+        quality (optional, int): JPEG quality. (Default: 95).
+    """
+    grid = torchvision.utils.make_grid(tensor.detach())
+    image = grid.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+    torchvision.io.write_jpeg(image.cpu(), filename, quality=quality)
@@ -12,11 +12,17 @@
 # limitations under the License.
 # ==============================================================================
 import argparse
+import contextlib
+import inspect
 import logging
 import os
 import random
+import shutil
+import socket
 import time
 import warnings
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.backends.cudnn as cudnn
@@ -27,12 +33,14 @@ import torch.nn.parallel
 import torch.optim
 import torch.utils.data
 import torch.utils.data.distributed
-import torchvision.utils as vutils
+from torch.cuda.amp import GradScaler
+from torch.cuda.amp import autocast
 from torch.utils.tensorboard import SummaryWriter
 
 import srgan_pytorch.models as models
 from srgan_pytorch.dataset import BaseTestDataset
 from srgan_pytorch.dataset import BaseTrainDataset
+from srgan_pytorch.dataset import CUDAPrefetcher
 from srgan_pytorch.loss import VGGLoss
 from srgan_pytorch.models.discriminator import discriminator_for_vgg
 from srgan_pytorch.utils.common import AverageMeter
@@ -40,6 +48,7 @@ from srgan_pytorch.utils.common import ProgressMeter
 from srgan_pytorch.utils.common import configure
 from srgan_pytorch.utils.common import create_folder
 from srgan_pytorch.utils.estimate import test
+from srgan_pytorch.utils.transform import save_jpeg
 
 model_names = sorted(name for name in models.__dict__
                      if name.islower() and not name.startswith("__")
@@ -67,6 +76,8 @@ parser.add_argument("--gan-epochs", default=4000, type=int, metavar="N",
                     help="Number of total gan epochs to run. (default: 4000)")
 parser.add_argument("--start-gan-epoch", default=0, type=int, metavar='N',
                     help="Manual gan epoch number (useful on restarts). (default: 0)")
+parser.add_argument("--eval-every", default=100, type=int, metavar="N",
+                    help="Test and save checkpoints every N epochs, the last epoch is always tested. (default: 100)")
 parser.add_argument("-b", "--batch-size", default=16, type=int,
                     metavar="N",
                     help="Mini-batch size (default: 16), this is the total "
@@ -115,6 +126,9 @@ parser.add_argument("--multiprocessing-distributed", action="store_true",
 def main():
     args = parser.parse_args()
 
+    if args.eval_every < 1:
+        parser.error(f"--eval-every must be at least 1, got {args.eval_every}.")
+
     if args.seed is not None:
         random.seed(args.seed)
         torch.manual_seed(args.seed)
@@ -134,6 +148,24 @@ def main():
     args.distributed = args.world_size > 1 or args.multiprocessing_distributed
 
     ngpus_per_node = torch.cuda.device_count()
+    if not args.distributed and args.gpu is None:
+        if ngpus_per_node > 1:
+            # Without an explicit GPU, use every card on this node through one
+            # DistributedDataParallel process per GPU instead of DataParallel.
+            logger.info(f"Found {ngpus_per_node} GPUs, launch single node distributed data parallel training.")
+            args.multiprocessing_distributed = True
+            args.distributed = True
+            args.world_size = 1
+            args.rank = 0
+            # Keep a user given address, otherwise rendezvous on a free local port.
+            if args.dist_url == parser.get_default("dist_url"):
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                    sock.bind(("127.0.0.1", 0))
+                    args.dist_url = f"tcp://127.0.0.1:{sock.getsockname()[1]}"
+            args.dist_backend = "nccl"
+        elif ngpus_per_node == 1:
+            args.gpu = 0
+
     if args.multiprocessing_distributed:
         # Since we have ngpus_per_node processes per node, the total world_size
         # needs to be adjusted accordingly
@@ -149,6 +181,10 @@ def main():
 def main_worker(gpu, ngpus_per_node, args):
     args.gpu = gpu
 
+    # Serialize checkpoints in the background while the next epoch is trained.
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    checkpoint_future = None
+
     if args.gpu is not None:
         logger.info(f"Use GPU: {args.gpu} for training.")
 
@@ -166,6 +202,9 @@ def main_worker(gpu, ngpus_per_node, args):
     # create model
     generator = configure(args)
     discriminator = discriminator_for_vgg(args.image_size)
+    # Convolutions run faster in NHWC layout on tensor cores, the layout is kept when moving to the GPU.
+    generator = generator.to(memory_format=torch.channels_last)
+    discriminator = discriminator.to(memory_format=torch.channels_last)
 
     if not torch.cuda.is_available():
         logger.warning("Using CPU, this will be slow.")
@@ -173,6 +212,8 @@ def main_worker(gpu, ngpus_per_node, args):
         # For multiprocessing distributed, DistributedDataParallel constructor
         # should always set the single device scope, otherwise,
         # DistributedDataParallel will use all available devices.
+        # Every parameter of the generator and discriminator takes part in each backward,
+        # so DistributedDataParallel does not need to search the graph for unused parameters.
         if args.gpu is not None:
             torch.cuda.set_device(args.gpu)
             discriminator.cuda(args.gpu)
@@ -184,46 +225,68 @@ def main_worker(gpu, ngpus_per_node, args):
             args.workers = int((args.workers + ngpus_per_node - 1) / ngpus_per_node)
             discriminator = nn.parallel.DistributedDataParallel(module=discriminator,
                                                                 device_ids=[args.gpu],
-                                                                find_unused_parameters=True)
+                                                                broadcast_buffers=False,
+                                                                find_unused_parameters=False)
             generator = nn.parallel.DistributedDataParallel(module=generator,
                                                             device_ids=[args.gpu],
-                                                            find_unused_parameters=True)
+                                                            broadcast_buffers=False,
+                                                            find_unused_parameters=False)
         else:
             discriminator.cuda()
             generator.cuda()
             # DistributedDataParallel will divide and allocate batch_size to all
             # available GPUs if device_ids are not set
-            discriminator = nn.parallel.DistributedDataParallel(discriminator, find_unused_parameters=True)
-            generator = nn.parallel.DistributedDataParallel(generator, find_unused_parameters=True)
-    elif args.gpu is not None:
+            discriminator = nn.parallel.DistributedDataParallel(discriminator,
+                                                                broadcast_buffers=False,
+                                                                find_unused_parameters=False)
+            generator = nn.parallel.DistributedDataParallel(generator,
+                                                            broadcast_buffers=False,
+                                                            find_unused_parameters=False)
+    else:
         torch.cuda.set_device(args.gpu)
         discriminator = discriminator.cuda(args.gpu)
         generator = generator.cuda(args.gpu)
+
+    # Checkpoints hold the state dicts of the unwrapped models, without the `module.` prefix of DDP.
+    if isinstance(generator, nn.parallel.DistributedDataParallel):
+        generator_module = generator.module
+        discriminator_module = discriminator.module
     else:
-        # DataParallel will divide and allocate batch_size to all available GPUs
-        if args.arch.startswith("alexnet") or args.arch.startswith("vgg"):
-            discriminator.features = torch.nn.DataParallel(discriminator.features)
-            generator.features = torch.nn.DataParallel(generator.features)
-            discriminator.cuda()
-            generator.cuda()
-        else:
-            discriminator = torch.nn.DataParallel(discriminator).cuda()
-            generator = torch.nn.DataParallel(generator).cuda()
+        generator_module = generator
+        discriminator_module = discriminator
+
+    # Compile after the DDP wrap, so the graphs are split at bucket boundaries and all-reduce overlaps backward.
+    # Without CUDA graphs, the extra compiles of the short last batch, eval and no_grad forwards stay cheap.
+    if hasattr(torch, "compile"):
+        import torch._dynamo
+        logger.info("Compiling generator and discriminator, frames that fail to compile fall back to eager mode.")
+        torch._dynamo.config.suppress_errors = True
+        generator = torch.compile(generator, mode="max-autotune-no-cudagraphs")
+        discriminator = torch.compile(discriminator, mode="max-autotune-no-cudagraphs")
 
     # Loss = content loss + 0.001 * adversarial loss
     pixel_criterion = nn.MSELoss().cuda(args.gpu)
     # We use VGG5.4 as our feature extraction method by default.
-    content_criterion = VGGLoss().cuda(args.gpu)
-    adversarial_criterion = nn.BCELoss().cuda(args.gpu)
+    content_criterion = VGGLoss().cuda(args.gpu).eval()
+    adversarial_criterion = nn.BCEWithLogitsLoss().cuda(args.gpu)
     logger.info(f"Losses function information:\n"
                 f"\tPixel:       MSELoss\n"
                 f"\tPerceptual:  VGG19_36th\n"
-                f"\tAdversarial: BCELoss")
+                f"\tAdversarial: BCEWithLogitsLoss")
+
+    # Update all parameters with fused (or multi-tensor) kernels when the installed torch supports it.
+    adam_parameters = inspect.signature(torch.optim.Adam).parameters
+    if "fused" in adam_parameters and torch.cuda.is_available():
+        adam_kwargs = {"fused": True}
+    elif "foreach" in adam_parameters:
+        adam_kwargs = {"foreach": True}
+    else:
+        adam_kwargs = {}
 
     # All optimizer function and scheduler function.
-    psnr_optimizer = torch.optim.Adam(generator.parameters(), lr=args.psnr_lr, betas=(0.9, 0.999))
-    discriminator_optimizer = torch.optim.Adam(discriminator.parameters(), lr=args.gan_lr, betas=(0.9, 0.999))
-    generator_optimizer = torch.optim.Adam(generator.parameters(), lr=args.gan_lr, betas=(0.9, 0.999))
+    psnr_optimizer = torch.optim.Adam(generator.parameters(), lr=args.psnr_lr, betas=(0.9, 0.999), **adam_kwargs)
+    discriminator_optimizer = torch.optim.Adam(discriminator.parameters(), lr=args.gan_lr, betas=(0.9, 0.999), **adam_kwargs)
+    generator_optimizer = torch.optim.Adam(generator.parameters(), lr=args.gan_lr, betas=(0.9, 0.999), **adam_kwargs)
     discriminator_scheduler = torch.optim.lr_scheduler.StepLR(discriminator_optimizer, args.gan_epochs // 2, 0.1)
     generator_scheduler = torch.optim.lr_scheduler.StepLR(generator_optimizer, args.gan_epochs // 2, 0.1)
     logger.info(f"Optimizer information:\n"
@@ -251,17 +314,24 @@ def main_worker(gpu, ngpus_per_node, args):
     else:
         train_sampler = None
 
+    # Keep the workers alive between epochs, they are only available in multi-process loading.
+    if args.workers > 0:
+        worker_kwargs = {"persistent_workers": True, "prefetch_factor": 4}
+    else:
+        worker_kwargs = {}
     train_dataloader = torch.utils.data.DataLoader(train_dataset,
                                                    batch_size=args.batch_size,
                                                    shuffle=(train_sampler is None),
                                                    pin_memory=True,
                                                    sampler=train_sampler,
-                                                   num_workers=args.workers)
+                                                   num_workers=args.workers,
+                                                   **worker_kwargs)
     test_dataloader = torch.utils.data.DataLoader(test_dataset,
                                                   batch_size=args.batch_size,
                                                   shuffle=False,
                                                   pin_memory=True,
-                                                  num_workers=args.workers)
+                                                  num_workers=args.workers,
+                                                  **worker_kwargs)
 
     logger.info(f"Dataset information:\n"
                 f"\tTrain Path:              {os.getcwd()}/{args.data}/train\n"
@@ -281,13 +351,10 @@ def main_worker(gpu, ngpus_per_node, args):
     if args.resume_psnr:
         if os.path.isfile(args.resume_psnr):
             logger.info(f"Loading checkpoint '{args.resume_psnr}'.")
-            if args.gpu is None:
-                checkpoint = torch.load(args.resume_psnr)
-            else:
-                # Map model to be loaded to specified single gpu.
-                checkpoint = torch.load(args.resume_psnr, map_location=f"cuda:{args.gpu}")
+            # Load on the CPU, `load_state_dict` copies the weights into the model's device.
+            checkpoint = torch.load(args.resume_psnr, map_location="cpu")
             args.start_psnr_epoch = checkpoint["epoch"]
-            generator.load_state_dict(checkpoint["state_dict"])
+            generator_module.load_state_dict(checkpoint["state_dict"])
             psnr_optimizer.load_state_dict(checkpoint["optimizer"])
             logger.info(f"Loaded checkpoint '{args.resume_psnr}' (epoch {checkpoint['epoch']}).")
         else:
@@ -297,17 +364,13 @@ def main_worker(gpu, ngpus_per_node, args):
         if os.path.isfile(args.resume_d) or os.path.isfile(args.resume_g):
             logger.info(f"Loading checkpoint '{args.resume_d}'.")
             logger.info(f"Loading checkpoint '{args.resume_g}'.")
-            if args.gpu is None:
-                checkpoint_d = torch.load(args.resume_d)
-                checkpoint_g = torch.load(args.resume_g)
-            else:
-                # Map model to be loaded to specified single gpu.
-                checkpoint_d = torch.load(args.resume_d, map_location=f"cuda:{args.gpu}")
-                checkpoint_g = torch.load(args.resume_g, map_location=f"cuda:{args.gpu}")
+            # Load on the CPU, `load_state_dict` copies the weights into the model's device.
+            checkpoint_d = torch.load(args.resume_d, map_location="cpu")
+            checkpoint_g = torch.load(args.resume_g, map_location="cpu")
             args.start_gan_epoch = checkpoint_d["epoch"]
-            discriminator.load_state_dict(checkpoint_d["state_dict"])
+            discriminator_module.load_state_dict(checkpoint_d["state_dict"])
             discriminator_optimizer.load_state_dict(checkpoint_d["optimizer"])
-            generator.load_state_dict(checkpoint_g["state_dict"])
+            generator_module.load_state_dict(checkpoint_g["state_dict"])
             generator_optimizer.load_state_dict(checkpoint_g["optimizer"])
             logger.info(f"Loaded checkpoint '{args.resume_d}' (epoch {checkpoint_d['epoch']}).")
             logger.info(f"Loaded checkpoint '{args.resume_g}' (epoch {checkpoint_g['epoch']}).")
@@ -315,15 +378,34 @@ def main_worker(gpu, ngpus_per_node, args):
             logger.info(f"No checkpoint found at '{args.resume_d}' or '{args.resume_g}'.")
 
     cudnn.benchmark = True
+    # Use TF32 tensor cores for the FP32 convolutions and matmuls on Ampere and newer GPUs.
+    torch.backends.cuda.matmul.allow_tf32 = True
+    cudnn.allow_tf32 = True
+
+    # Scale the losses of the mixed precision training.
+    psnr_scaler = GradScaler()
+    discriminator_scaler = GradScaler()
+    generator_scaler = GradScaler()
+
+    # Only the first process of each node writes logs, images and checkpoints.
+    is_main_process = not args.multiprocessing_distributed or args.rank % ngpus_per_node == 0
 
     # Create a SummaryWriter at the beginning of training.
-    psnr_writer = SummaryWriter(f"runs/{args.arch}_psnr_logs")
-    gan_writer = SummaryWriter(f"runs/{args.arch}_gan_logs")
+    if is_main_process:
+        psnr_writer = SummaryWriter(f"runs/{args.arch}_psnr_logs")
+        gan_writer = SummaryWriter(f"runs/{args.arch}_gan_logs")
+    else:
+        psnr_writer = None
+        gan_writer = None
 
     logger.info(f"Train information:\n"
                 f"\tPSNR-oral epochs: {args.psnr_epochs}\n"
                 f"\tGAN-oral epochs:  {args.gan_epochs}")
 
+    # Only a PSNR stage trained in this run may replace the generator weights before the GAN stage.
+    train_psnr_stage = args.start_psnr_epoch < args.psnr_epochs
+
+    best_psnr_value = 0.0
     for epoch in range(args.start_psnr_epoch, args.psnr_epochs):
         if args.distributed:
             train_sampler.set_epoch(epoch)
@@ -333,28 +415,51 @@ def main_worker(gpu, ngpus_per_node, args):
                    generator=generator,
                    pixel_criterion=pixel_criterion,
                    psnr_optimizer=psnr_optimizer,
+                   psnr_scaler=psnr_scaler,
                    epoch=epoch,
                    writer=psnr_writer,
+                   is_main_process=is_main_process,
                    args=args)
 
-        # Test for every epoch.
+        # Test every `--eval-every` epochs and after the last epoch.
+        if (epoch + 1) % args.eval_every != 0 and epoch != args.psnr_epochs - 1:
+            continue
         psnr_value, ssim_value, lpips_value, gmsd_value = test(generator, test_dataloader, args.gpu)
-        gan_writer.add_scalar("Test/PSNR", psnr_value, epoch + 1)
-        gan_writer.add_scalar("Test/SSIM", ssim_value, epoch + 1)
-        gan_writer.add_scalar("Test/LPIPS", lpips_value, epoch + 1)
-        gan_writer.add_scalar("Test/GMSD", gmsd_value, epoch + 1)
-
-        if not args.multiprocessing_distributed or (
-                args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
-            torch.save({"epoch": epoch + 1,
-                        "arch": args.arch,
-                        "state_dict": generator.module.state_dict() if args.multiprocessing_distributed else generator.state_dict(),
-                        "optimizer": psnr_optimizer.state_dict(),
-                        }, os.path.join("weights", f"PSNR_epoch{epoch}.pth"))
-
-        # Load best PSNR model.
-        generator.load_state_dict(torch.load(os.path.join("weights", f"PSNR.pth"), map_location=f"cuda:{args.gpu}"))
+        is_best = float(psnr_value) > best_psnr_value
+        best_psnr_value = max(float(psnr_value), best_psnr_value)
+
+        if is_main_process:
+            gan_writer.add_scalar("Test/PSNR", psnr_value, epoch + 1)
+            gan_writer.add_scalar("Test/SSIM", ssim_value, epoch + 1)
+            gan_writer.add_scalar("Test/LPIPS", lpips_value, epoch + 1)
+            gan_writer.add_scalar("Test/GMSD", gmsd_value, epoch + 1)
+
+            # Wait for the previous checkpoint, at most one is written at a time.
+            if checkpoint_future is not None:
+                checkpoint_future.result()
+            checkpoint_future = save_checkpoints(checkpoint_executor, {
+                "PSNR": {"epoch": epoch + 1,
+                         "arch": args.arch,
+                         "state_dict": generator_module.state_dict(),
+                         "optimizer": psnr_optimizer.state_dict(),
+                         }}, is_best)
+
+    # Load best PSNR model before the GAN stage.
+    if train_psnr_stage:
+        # The last PSNR checkpoint may still be written in the background, and under DDP
+        # only the first process of each node writes it, so every process waits for it.
+        if checkpoint_future is not None:
+            checkpoint_future.result()
+        if args.distributed:
+            dist.barrier()
+
+        psnr_model_path = os.path.join("weights", "PSNR_best.pth")
+        if os.path.isfile(psnr_model_path):
+            logger.info(f"Loading best PSNR model '{psnr_model_path}'.")
+            checkpoint = torch.load(psnr_model_path, map_location="cpu")
+            generator_module.load_state_dict(checkpoint["state_dict"])
 
+    best_psnr_value = 0.0
     for epoch in range(args.start_gan_epoch, args.gan_epochs):
         if args.distributed:
             train_sampler.set_epoch(epoch)
@@ -367,40 +472,95 @@ def main_worker(gpu, ngpus_per_node, args):
                   adversarial_criterion=adversarial_criterion,
                   discriminator_optimizer=discriminator_optimizer,
                   generator_optimizer=generator_optimizer,
+                  discriminator_scaler=discriminator_scaler,
+                  generator_scaler=generator_scaler,
                   epoch=epoch,
                   writer=gan_writer,
+                  is_main_process=is_main_process,
                   args=args)
 
         discriminator_scheduler.step()
         generator_scheduler.step()
 
-        # Test for every epoch.
+        # Test every `--eval-every` epochs and after the last epoch.
+        if (epoch + 1) % args.eval_every != 0 and epoch != args.gan_epochs - 1:
+            continue
         psnr_value, ssim_value, lpips_value, gmsd_value = test(generator, test_dataloader, args.gpu)
-        gan_writer.add_scalar("Test/PSNR", psnr_value, epoch + 1)
-        gan_writer.add_scalar("Test/SSIM", ssim_value, epoch + 1)
-        gan_writer.add_scalar("Test/LPIPS", lpips_value, epoch + 1)
-        gan_writer.add_scalar("Test/GMSD", gmsd_value, epoch + 1)
-
-        if not args.multiprocessing_distributed or (
-                args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
-            torch.save({"epoch": epoch + 1,
-                        "arch": "vgg",
-                        "state_dict": discriminator.module.state_dict() if args.multiprocessing_distributed else discriminator.state_dict(),
-                        "optimizer": discriminator_optimizer.state_dict()
-                        }, os.path.join("weights", f"Discriminator_epoch{epoch}.pth"))
-            torch.save({"epoch": epoch + 1,
-                        "arch": args.arch,
-                        "state_dict": generator.module.state_dict() if args.multiprocessing_distributed else generator.state_dict(),
-                        "optimizer": generator_optimizer.state_dict()
-                        }, os.path.join("weights", f"Generator_epoch{epoch}.pth"))
+        is_best = float(psnr_value) > best_psnr_value
+        best_psnr_value = max(float(psnr_value), best_psnr_value)
+
+        if is_main_process:
+            gan_writer.add_scalar("Test/PSNR", psnr_value, epoch + 1)
+            gan_writer.add_scalar("Test/SSIM", ssim_value, epoch + 1)
+            gan_writer.add_scalar("Test/LPIPS", lpips_value, epoch + 1)
+            gan_writer.add_scalar("Test/GMSD", gmsd_value, epoch + 1)
+
+            # Wait for the previous checkpoint, at most one is written at a time.
+            if checkpoint_future is not None:
+                checkpoint_future.result()
+            checkpoint_future = save_checkpoints(checkpoint_executor, {
+                "Discriminator": {"epoch": epoch + 1,
+                                  "arch": "vgg",
+                                  "state_dict": discriminator_module.state_dict(),
+                                  "optimizer": discriminator_optimizer.state_dict()
+                                  },
+                "Generator": {"epoch": epoch + 1,
+                              "arch": args.arch,
+                              "state_dict": generator_module.state_dict(),
+                              "optimizer": generator_optimizer.state_dict()
+                              }}, is_best)
+
+    # Make sure the last checkpoint is on disk before leaving.
+    if checkpoint_future is not None:
+        checkpoint_future.result()
+    checkpoint_executor.shutdown()
+
+
+def copy_to_cpu(data):
+    r"""Recursively copy the tensors of a state dict to the CPU, so training can keep updating the originals."""
+    if torch.is_tensor(data):
+        return data.detach().to("cpu", copy=True)
+    elif isinstance(data, dict):
+        return {key: copy_to_cpu(value) for key, value in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return type(data)(copy_to_cpu(value) for value in data)
+    return data
+
+
+def write_checkpoints(states: dict, is_best: bool) -> None:
+    for name, state in states.items():
+        latest_path = os.path.join("weights", f"{name}_latest.pth")
+        # Write a temporary file first, an interrupted save never corrupts the previous checkpoint.
+        torch.save(state, f"{latest_path}.tmp")
+        os.replace(f"{latest_path}.tmp", latest_path)
+        if is_best:
+            best_path = os.path.join("weights", f"{name}_best.pth")
+            shutil.copyfile(latest_path, f"{best_path}.tmp")
+            os.replace(f"{best_path}.tmp", best_path)
+
+
+def save_checkpoints(executor: ThreadPoolExecutor, states: dict, is_best: bool) -> Future:
+    r"""Save checkpoints in the background.
+
+    Args:
+        executor (ThreadPoolExecutor): Executor that writes the files.
+        states (dict): Checkpoint states by name, saved to `weights/{name}_latest.pth`.
+        is_best (bool): Also copy the checkpoints to `weights/{name}_best.pth`.
+
+    Returns:
+        Future of the background save.
+    """
+    return executor.submit(write_checkpoints, copy_to_cpu(states), is_best)
 
 
 def train_psnr(train_dataloader: torch.utils.data.DataLoader,
                generator: nn.Module,
                pixel_criterion: nn.MSELoss,
                psnr_optimizer: torch.optim.Adam,
+               psnr_scaler: GradScaler,
                epoch: int,
                writer: SummaryWriter,
+               is_main_process: bool,
                args: argparse.ArgumentParser.parse_args):
     batch_time = AverageMeter("Time", ":6.4f")
     mse_losses = AverageMeter("MSE Loss", ":.6f")
@@ -409,52 +569,87 @@ def train_psnr(train_dataloader: torch.utils.data.DataLoader,
     # switch to train mode
     generator.train()
 
-    end = time.time()
-    for i, (lr, hr) in enumerate(train_dataloader):
-        # Move data to special device.
-        if args.gpu is not None:
-            lr = lr.cuda(args.gpu, non_blocking=True)
-            hr = hr.cuda(args.gpu, non_blocking=True)
+    # Accumulate the loss on the device and only synchronize when it is displayed.
+    # Allocated on the current device (set to `args.gpu`), so no pageable host copy is made.
+    losses_buffer = torch.zeros(1, device="cuda")
+    num_samples = 0
+    num_batches = 0
 
-        generator.zero_grad()
+    # Copy the next batch to the device while the current one is computed.
+    prefetcher = CUDAPrefetcher(train_dataloader, args.gpu, memory_format=torch.channels_last)
+    prefetcher.reset()
+    batch = prefetcher.next()
 
-        # Generating fake high resolution images from real low resolution images.
-        sr = generator(lr)
-        # The MSE Loss of the generated fake high-resolution image and real high-resolution image is calculated.
-        mse_loss = pixel_criterion(sr, hr)
-        mse_loss.backward()
-        psnr_optimizer.step()
+    i = 0
+    end = time.time()
+    while batch is not None:
+        lr, hr = batch
+
+        generator.zero_grad(set_to_none=True)
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+        with autocast():
+            # Generating fake high resolution images from real low resolution images.
+            sr = generator(lr)
+            # The MSE Loss of the generated fake high-resolution image and real high-resolution image is calculated.
+            mse_loss = pixel_criterion(sr, hr)
+        psnr_scaler.scale(mse_loss).backward()
+        psnr_scaler.step(psnr_optimizer)
+        psnr_scaler.update()
 
         # measure accuracy and record loss
-        mse_losses.update(mse_loss.item(), lr.size(0))
+        losses_buffer[0] += mse_loss.detach() * lr.size(0)
+        num_samples += lr.size(0)
+        num_batches += 1
 
         iters = i + epoch * len(train_dataloader) + 1
-        writer.add_scalar("Train/MSE Loss", mse_loss.item(), iters)
 
         # Output results every 100 batches.
         if i % 100 == 0:
+            mse_loss_value = losses_buffer[0].item() / num_samples
+            mse_losses.update(mse_loss_value, num_samples)
+            if is_main_process:
+                writer.add_scalar("Train/MSE Loss", mse_loss_value, iters)
+            losses_buffer.zero_()
+            num_samples = 0
+
+            # measure elapsed time, the read back above waits for every batch since the last display.
+            batch_time.update((time.time() - end) / num_batches, num_batches)
+            end = time.time()
+            num_batches = 0
+
             progress.display(i)
 
-        # Save image every 1000 batches.
-        if iters % 1000 == 0:
-            vutils.save_image(hr, os.path.join("runs", "hr", f"PSNR_{iters}.bmp"))
-            sr = generator(lr)
-            vutils.save_image(sr.detach(), os.path.join("runs", "sr", f"PSNR_{iters}.bmp"))
+        # Save image every 1000 batches, only the first process of each node writes images.
+        if iters % 1000 == 0 and is_main_process:
+            save_jpeg(hr, os.path.join("runs", "hr", f"PSNR_{iters}.jpg"))
+            with torch.no_grad():
+                sr = generator(lr)
+            save_jpeg(sr, os.path.join("runs", "sr", f"PSNR_{iters}.jpg"))
+
+        batch = prefetcher.next()
+        i += 1
+
+    # Record the batches after the last display, so the epoch averages cover every batch.
+    if num_samples > 0:
+        mse_loss_value = losses_buffer[0].item() / num_samples
+        mse_losses.update(mse_loss_value, num_samples)
+        batch_time.update((time.time() - end) / num_batches, num_batches)
+        if is_main_process:
+            writer.add_scalar("Train/MSE Loss", mse_loss_value, iters)
 
 
 def train_gan(train_dataloader: torch.utils.data.DataLoader,
               discriminator: nn.Module,
               generator: nn.Module,
               content_criterion: VGGLoss,
-              adversarial_criterion: nn.BCELoss,
+              adversarial_criterion: nn.BCEWithLogitsLoss,
               discriminator_optimizer: torch.optim.Adam,
               generator_optimizer: torch.optim.Adam,
+              discriminator_scaler: GradScaler,
+              generator_scaler: GradScaler,
               epoch: int,
               writer: SummaryWriter,
+              is_main_process: bool,
               args: argparse.ArgumentParser.parse_args):
     batch_time = AverageMeter("Time", ":.4f")
     d_losses = AverageMeter("D Loss", ":.6f")
@@ -472,98 +667,143 @@ def train_gan(train_dataloader: torch.utils.data.DataLoader,
          content_losses, adversarial_losses,
          d_hr_values, d_sr1_values, d_sr2_values],
         prefix=f"Epoch: [{epoch}]")
+    meters = [d_losses, g_losses, content_losses, adversarial_losses, d_hr_values, d_sr1_values, d_sr2_values]
+    tags = ["D Loss", "G Loss", "Content Loss", "Adversarial Loss", "D(LR)", "D(SR1)", "D(SR2)"]
 
     # switch to train mode
     discriminator.train()
     generator.train()
 
+    # The real sample label is 1, and the generated sample label is 0.
+    # Labels only depend on the batch size, so allocate them once per epoch.
+    # They are filled on the current device (set to `args.gpu`), so no pageable host copy is made.
+    real_labels = torch.ones((args.batch_size, 1), device="cuda")
+    fake_labels = torch.zeros_like(real_labels)
+
+    # The discriminator gradients of the generator update are thrown away, so skip their all-reduce.
+    # `torch.compile` keeps the DDP module as `_orig_mod`.
+    if isinstance(getattr(discriminator, "_orig_mod", discriminator), nn.parallel.DistributedDataParallel):
+        discriminator_no_sync = discriminator.no_sync
+    else:
+        discriminator_no_sync = contextlib.nullcontext
+
+    # Accumulate the values of `meters` on the device and only synchronize when they are displayed.
+    values_buffer = torch.zeros(len(meters), device="cuda")
+    num_samples = 0
+    num_batches = 0
+
+    # Copy the next batch to the device while the current one is computed.
+    prefetcher = CUDAPrefetcher(train_dataloader, args.gpu, memory_format=torch.channels_last)
+    prefetcher.reset()
+    batch = prefetcher.next()
+
+    i = 0
     end = time.time()
-    for i, (lr, hr) in enumerate(train_dataloader):
-        # Move data to special device.
-        if args.gpu is not None:
-            lr = lr.cuda(args.gpu, non_blocking=True)
-            hr = hr.cuda(args.gpu, non_blocking=True)
+    while batch is not None:
+        lr, hr = batch
         batch_size = lr.size(0)
 
-        # The real sample label is 1, and the generated sample label is 0.
-        real_label = torch.full((batch_size, 1), 1, dtype=lr.dtype).cuda(args.gpu, non_blocking=True)
-        fake_label = torch.full((batch_size, 1), 0, dtype=lr.dtype).cuda(args.gpu, non_blocking=True)
+        # The VGG features of the real sample never need gradients, extract them once per batch.
+        with torch.no_grad(), autocast():
+            hr_features = content_criterion.features(hr)
+
+        # The last batch of an epoch may be smaller, only use the leading labels.
+        real_label = real_labels[:batch_size]
+        fake_label = fake_labels[:batch_size]
 
         ##############################################
         # (1) Update D network: maximize - E(hr)[log(D(hr))] + E(lr)[log(1- D(G(lr))]
         ##############################################
         # Set discriminator gradients to zero.
-        discriminator.zero_grad()
+        discriminator.zero_grad(set_to_none=True)
 
-        real_output = discriminator(hr)
-        # Let the discriminator realize that the sample is real.
-        d_loss_real = adversarial_criterion(real_output, real_label)
+        with autocast():
+            # Judge real and fake samples in separate passes, so the BatchNorm layers of the discriminator
+            # never mix real and fake statistics, the same as in the generator update.
+            real_output = discriminator(hr)
+            # Let the discriminator realize that the sample is real.
+            d_loss_real = adversarial_criterion(real_output, real_label)
 
-        # Generating fake high resolution images from real low resolution images.
-        sr = generator(lr)
-        fake_output = discriminator(sr.detach())
-        # Let the discriminator realize that the sample is false.
-        d_loss_fake = adversarial_criterion(fake_output, fake_label)
+            # Generating fake high resolution images from real low resolution images.
+            sr = generator(lr)
+            fake_output = discriminator(sr.detach())
+            # Let the discriminator realize that the sample is false.
+            d_loss_fake = adversarial_criterion(fake_output, fake_label)
 
-        # Count all discriminator losses.
-        d_loss = (d_loss_real + d_loss_fake) / 2
-        d_loss.backward()
-        d_hr = real_output.mean().item()
-        d_sr1 = fake_output.mean().item()
+            # Count all discriminator losses.
+            d_loss = (d_loss_real + d_loss_fake) / 2
+        discriminator_scaler.scale(d_loss).backward()
 
         # Update discriminator optimizer gradient information.
-        discriminator_optimizer.step()
+        discriminator_scaler.step(discriminator_optimizer)
+        discriminator_scaler.update()
 
         ##############################################
         # (2) Update G network: content loss + 0.001 * adversarial loss
         ##############################################
         # Set discriminator gradients to zero.
-        generator.zero_grad()
+        generator.zero_grad(set_to_none=True)
 
-        # Based on VGG19_36th pre training model to find the maximum square error between feature maps.
-        content_loss = content_criterion(sr, hr.detach())
+        with discriminator_no_sync():
+            with autocast():
+                # Based on VGG19_36th pre training model to find the maximum square error between feature maps.
+                content_loss = content_criterion(sr, target_features=hr_features)
 
-        fake_output = discriminator(sr)
-        # Let the discriminator realize that the sample is true.
-        adversarial_loss = adversarial_criterion(fake_output, real_label)
-        g_loss = content_loss + 0.001 * adversarial_loss
-        g_loss.backward()
-        d_sr2 = fake_output.mean().item()
+                sr_output = discriminator(sr)
+                # Let the discriminator realize that the sample is true.
+                adversarial_loss = adversarial_criterion(sr_output, real_label)
+                g_loss = content_loss + 0.001 * adversarial_loss
+            generator_scaler.scale(g_loss).backward()
 
         # Update generator optimizer gradient information.
-        generator_optimizer.step()
+        generator_scaler.step(generator_optimizer)
+        generator_scaler.update()
 
         # measure accuracy and record loss
-        d_losses.update(d_loss.item(), lr.size(0))
-        g_losses.update(g_loss.item(), lr.size(0))
-        content_losses.update(content_loss.item(), lr.size(0))
-        adversarial_losses.update(adversarial_loss.item(), lr.size(0))
-        d_hr_values.update(d_hr, lr.size(0))
-        d_sr1_values.update(d_sr1, lr.size(0))
-        d_sr2_values.update(d_sr2, lr.size(0))
-
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+        losses = torch.stack([d_loss, g_loss, content_loss, adversarial_loss]).detach().float()
+        # D(x), D(SR1) and D(SR2) in one reduction over the discriminator logits of both updates.
+        d_values = torch.sigmoid(torch.cat([real_output, fake_output, sr_output]).detach().float()).view(3, -1).mean(1)
+        values_buffer += torch.cat([losses, d_values]) * batch_size
+        num_samples += batch_size
+        num_batches += 1
 
         iters = i + epoch * len(train_dataloader) + 1
-        writer.add_scalar("Train/D Loss", d_loss.item(), iters)
-        writer.add_scalar("Train/G Loss", d_loss.item(), iters)
-        writer.add_scalar("Train/Content Loss", content_loss.item(), iters)
-        writer.add_scalar("Train/Adversarial Loss", adversarial_loss.item(), iters)
-        writer.add_scalar("Train/D(LR)", d_hr, iters)
-        writer.add_scalar("Train/D(SR1)", d_sr1, iters)
-        writer.add_scalar("Train/D(SR2)", d_sr2, iters)
 
         # Output results every 100 batches.
         if i % 100 == 0:
+            values = (values_buffer / num_samples).tolist()
+            for meter, tag, value in zip(meters, tags, values):
+                meter.update(value, num_samples)
+                if is_main_process:
+                    writer.add_scalar(f"Train/{tag}", value, iters)
+            values_buffer.zero_()
+            num_samples = 0
+
+            # measure elapsed time, the read back above waits for every batch since the last display.
+            batch_time.update((time.time() - end) / num_batches, num_batches)
+            end = time.time()
+            num_batches = 0
+
             progress.display(i)
 
-        # Save image every 1000 batches.
-        if iters % 1000 == 0:
-            vutils.save_image(hr, os.path.join("runs", "hr", f"GAN_{iters}.bmp"))
-            sr = generator(lr)
-            vutils.save_image(sr.detach(), os.path.join("runs", "sr", f"GAN_{iters}.bmp"))
+        # Save image every 1000 batches, only the first process of each node writes images.
+        if iters % 1000 == 0 and is_main_process:
+            save_jpeg(hr, os.path.join("runs", "hr", f"GAN_{iters}.jpg"))
+            with torch.no_grad():
+                sr = generator(lr)
+            save_jpeg(sr, os.path.join("runs", "sr", f"GAN_{iters}.jpg"))
+
+        batch = prefetcher.next()
+        i += 1
+
+    # Record the batches after the last display, so the epoch averages cover every batch.
+    if num_samples > 0:
+        values = (values_buffer / num_samples).tolist()
+        for meter, tag, value in zip(meters, tags, values):
+            meter.update(value, num_samples)
+            if is_main_process:
+                writer.add_scalar(f"Train/{tag}", value, iters)
+        batch_time.update((time.time() - end) / num_batches, num_batches)
 
     if __name__ == "__main__":
         print("##################################################\n")